@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Author:  Fabien Hochstrasser
@@ -6,12 +6,35 @@
 # Purpose: Redact a file by replacing secret values by placeholders.
 #
 import argparse
+import collections
+import concurrent.futures
+import functools
+import heapq
+import io
+import itertools
 import os
+import pickle
 import re
 import subprocess
 import sys
 
-from collections import defaultdict
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+
+try:
+    # Optional: RE2 matches in linear time (no catastrophic backtracking)
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    # Optional: Aho-Corasick automaton to substitute the secrets in one pass
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 CONFIG_DIRS = [
@@ -22,6 +45,16 @@ PATTERNS = 'patterns'
 SUBSTITUTIONS = 'substitutions'
 VALIDATORS = 'validators'
 
+# Size (in bytes) of the blocks of lines read and written at once
+BLOCK_SIZE = 1 << 20
+
+# Maximum number of validator scripts running at the same time
+MAX_VALIDATORS = 16
+
+# Minimum number of strings redacted without finding new secrets before
+# compiling all the secrets of a Redacter in a single regex
+STABLE_LINES = 1000
+
 
 def main(args):
     """Redact the files one-by-one, in the order they are given.
@@ -37,71 +70,344 @@ def main(args):
     redacters = [
         Redacter.create(
             substitution_string=secret,
-            regex_file=config[secret][PATTERNS],
-            substitutions_file=config[secret][SUBSTITUTIONS],
-            validator_file=config[secret][VALIDATORS],
+            regex_lines=config[secret].get(PATTERNS, []),
+            substitutions_lines=config[secret].get(SUBSTITUTIONS, []),
+            validator_file=config[secret].get(VALIDATORS),
         )
         for secret in config if secret in secrets
     ]
     # Redacter.create() returns None When no useful configuration was found
-    redacters = filter(lambda x: x is not None, redacters)
+    redacters = [redacter for redacter in redacters if redacter is not None]
 
     if not redacters:
         print('Couldn\'t parse any configuration file')
         sys.exit(1)
 
-    with open(args.file, 'r') as f:
-        for line in f:
-            for redacter in redacters:
-                line = redacter.redact(line)
-            sys.stdout.write(line)
+    # The file is redacted as bytes, there's no need to decode it. The redacted
+    # lines are written to stdout through a buffer of BLOCK_SIZE bytes.
+    sys.stdout.flush()
+    out = io.open(sys.stdout.fileno(), 'wb', BLOCK_SIZE, closefd=False)
+    try:
+        with out, open(args.file, 'rb', BLOCK_SIZE) as f:
+            # Let the kernel know the file is read sequentially (read-ahead)
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    # e.g. the file is a pipe
+                    pass
+
+            if args.jobs > 1:
+                blocks = redact_parallel(read_blocks(f), redacters, args.jobs)
+            else:
+                blocks = (redact_block(redacters, lines)[0] for lines in read_blocks(f))
+
+            for lines in blocks:
+                out.writelines(lines)
+    finally:
+        for redacter in redacters:
+            redacter.close()
 
     # Write the substitutions to the disk
     if not args.write_substitutions:
         return
     for redacter in redacters:
-         with open(os.path.join(args.write_substitutions, redacter.substitution_string), 'w') as f:
+         with open(os.path.join(args.write_substitutions, redacter.substitution_string), 'wb') as f:
              for secret in redacter.substitutions:
-                 f.write('{} = {}\n'.format(secret, redacter.substitutions[secret]))
+                 f.write(b'%s = %s\n' % (secret, redacter.substitutions[secret]))
+
+
+def redact_block(redacters, lines):
+    """Redact a block of lines with each redacter (in that order).
+
+    Returns: The redacted lines and the redacters if they found new secrets (None otherwise).
+    """
+    counts = [len(redacter.substitutions) for redacter in redacters]
+    for redacter in redacters:
+        lines = list(map(redacter.redact, lines))
+
+    if [len(redacter.substitutions) for redacter in redacters] != counts:
+        return lines, redacters
+    return lines, None
+
+
+def _redact_pickled_block(pickled_redacters, lines):
+    """Redact a block of lines in a worker process (see redact_parallel()).
+
+    Returns: The result of redact_block(), and the new decisions of the
+             validator script of each redacter.
+    """
+    redacters = pickle.loads(pickled_redacters)
+    counts = [len(redacter._validate_cache) for redacter in redacters]
+    try:
+        lines, updated = redact_block(redacters, lines)
+        # The decisions are cached in the order they were made
+        decisions = [
+            dict(itertools.islice(redacter._validate_cache.items(), count, None))
+            for redacter, count in zip(redacters, counts)
+        ]
+        return lines, updated, decisions
+    finally:
+        for redacter in redacters:
+            redacter.close()
+
+
+def redact_parallel(blocks, redacters, jobs):
+    """Yields the redacted blocks of lines, redacting them in `jobs` processes.
+
+    Each worker redacts a block with a copy of the redacters, as they were
+    when the block was submitted. Its result is only used if the redacters
+    didn't find any new secret in the meantime, otherwise the block is
+    redacted again in this process. This keeps the same 1-to-1 mapping
+    between the secrets and their substitutions as a sequential redaction.
+    The decisions of the validator scripts are always kept, so that they're
+    not run again for the next blocks.
+
+    Args:
+        blocks: An iterable of lists of lines.
+        redacters: The list of redacters. It's updated with the redacters
+                   used by the workers when they found new secrets (the
+                   replaced ones are closed).
+        jobs: The number of worker processes.
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    blocks = iter(blocks)
+    # The submitted blocks, with the version of the redacters used
+    pending = collections.deque()
+    # Incremented each time the redacters find new secrets
+    version = 0
+
+    try:
+        while True:
+            # Keep up to 2 blocks per worker in the queue
+            for lines in itertools.islice(blocks, 2 * jobs - len(pending)):
+                # The redacters are pickled right away, they might change
+                # before the executor sends them to the worker
+                pickled = pickle.dumps(redacters, pickle.HIGHEST_PROTOCOL)
+                future = executor.submit(_redact_pickled_block, pickled, lines)
+                pending.append((version, lines, future))
+
+            if not pending:
+                return
+
+            submitted_version, lines, future = pending.popleft()
+            redacted, updated, decisions = future.result()
+            for redacter, decided in zip(redacters, decisions):
+                redacter._validate_cache.update(decided)
+            if submitted_version != version:
+                redacted, updated = redact_block(redacters, lines)
+
+            if updated is not None:
+                if updated is not redacters:
+                    # Replaced by the redacters used by the worker, which don't
+                    # have the decisions merged since the block was submitted
+                    for redacter, replacement in zip(redacters, updated):
+                        replacement._validate_cache.update(redacter._validate_cache)
+                        redacter.close()
+                    redacters[:] = updated
+                version += 1
+
+            yield redacted
+    finally:
+        # Only the blocks being redacted are waited for. Not waiting at all
+        # can deadlock the interpreter at exit (Python 3.8)
+        for _, _, future in pending:
+            future.cancel()
+        executor.shutdown()
 
 
 def get_config(config_dirs):
-    """Return the secrets and their configuration files.
+    """Return the secrets and their configuration.
 
     For each `config_type` (patterns, substitutions, validators), the first
-    configuration file found is returned.
+    configuration file found is used. The patterns and substitutions files are
+    read right away, the validators are scripts (their path is returned).
 
     Args:
         config_dirs: The configuration directories to traverse (in that order),
                      as a list of paths (string).
 
-    Returns: A dict (key=secret name) of dicts (key=config_type) of file paths.
+    Returns: A dict (key=secret name) of dicts (key=config_type) of lists of
+             uncommented lines (bytes), or of file paths for the validators.
+             The config_types without configuration file are missing.
     """
-    secrets = defaultdict(lambda: defaultdict(lambda: None))
+    secrets = {}
 
     for d in config_dirs:
         for config_type in [PATTERNS, SUBSTITUTIONS, VALIDATORS]:
             try:
-                files = os.listdir(os.path.join(d, config_type))
+                entries = os.scandir(os.path.join(d, config_type))
             except OSError:
                 # Don't crash for non-existing directories
                 continue
 
-            for name in files:
-                # Don't overwrite existing values, the first one found is kept
-                if config_type not in secrets[name]:
-                    secrets[name][config_type] = os.path.join(d, config_type, name)
-            
+            with entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    # Don't overwrite existing values, the first one found is kept
+                    config = secrets.setdefault(entry.name, {})
+                    if config_type in config:
+                        continue
+                    config[config_type] = (
+                        entry.path
+                        if config_type == VALIDATORS
+                        else list(read_uncommented_lines(entry.path))
+                    )
+
     return secrets
 
 
+def compile_linear_regex(regex, compatible=None):
+    """Return the compiled regex, using RE2 if it's available.
+
+    RE2 doesn't support all the features of the re module (e.g. backreferences
+    or lookarounds). The regular expressions it cannot compile are compiled
+    with the re module, like the ones it would match differently (see
+    re2_compatible()).
+
+    Args:
+        regex: The regular expression (bytes).
+        compatible: The result of re2_compatible(regex), if it's already known.
+    """
+    if compatible is None:
+        compatible = re2 is not None and re2_compatible(regex)
+    if re2 is not None and compatible:
+        options = re2.Options()
+        # Match bytes, not UTF-8 characters
+        options.encoding = re2.Options.Encoding.LATIN1
+        try:
+            return re2.compile(regex, options)
+        except re2.error:
+            pass
+    return re.compile(regex)
+
+
+def re2_compatible(regex):
+    """Return True if RE2 matches the regex (bytes) like the re module, if it compiles it.
+
+    RE2's $ only matches at the end of the string, not before a trailing
+    newline (the lines keep theirs), and its \\s doesn't match \\v. After an
+    empty match, it doesn't look for a non-empty one at the same position.
+    """
+    try:
+        items = sre_parse.parse(regex)
+    except re.error:
+        return False
+    if items.getwidth()[0] == 0:
+        return False
+    return not any(
+        (op == sre_parse.AT and av == sre_parse.AT_END)
+        or (op == sre_parse.CATEGORY and av in (sre_parse.CATEGORY_SPACE, sre_parse.CATEGORY_NOT_SPACE))
+        for op, av in regex_items(items)
+    )
+
+
+# The bytes matched by the categories of the regular expressions (e.g. \d)
+CATEGORY_BYTES = {
+    sre_parse.CATEGORY_DIGIT: b'0123456789',
+    sre_parse.CATEGORY_SPACE: b' \t\n\r\f\v',
+    sre_parse.CATEGORY_WORD: b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_',
+}
+
+
+def first_bytes(regex):
+    """Return the set of bytes a match of the compiled regex can start with.
+
+    Returns: A set of bytes (as integers), or None if the match could start
+             with any byte (or be empty), or if it's too hard to tell.
+    """
+    if regex.flags & (re.IGNORECASE | re.LOCALE):
+        return None
+
+    def first(items):
+        """Return the first bytes of the sequence of items, and if it might be empty."""
+        result = set()
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                return result | {av}, False
+            elif op == sre_parse.IN:
+                for item_op, item_av in av:
+                    if item_op == sre_parse.LITERAL:
+                        result.add(item_av)
+                    elif item_op == sre_parse.RANGE:
+                        result.update(range(item_av[0], item_av[1] + 1))
+                    elif item_op == sre_parse.CATEGORY and item_av in CATEGORY_BYTES:
+                        result.update(CATEGORY_BYTES[item_av])
+                    else:
+                        # e.g. [^a] or \S
+                        return None, False
+                return result, False
+            elif op == sre_parse.BRANCH:
+                nullable = False
+                for branch in av[1]:
+                    branch_result, branch_nullable = first(branch)
+                    if branch_result is None:
+                        return None, False
+                    result |= branch_result
+                    nullable = nullable or branch_nullable
+                if not nullable:
+                    return result, False
+            elif op == sre_parse.SUBPATTERN:
+                # (group, add_flags, del_flags, pattern)
+                if av[1] & (re.IGNORECASE | re.LOCALE):
+                    return None, False
+                sub_result, nullable = first(av[-1])
+                if sub_result is None:
+                    return None, False
+                result |= sub_result
+                if not nullable:
+                    return result, False
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                sub_result, nullable = first(av[2])
+                if sub_result is None:
+                    return None, False
+                result |= sub_result
+                if av[0] > 0 and not nullable:
+                    return result, False
+            elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                # Zero-width, the match starts with the next item
+                continue
+            else:
+                # e.g. . or a backreference
+                return None, False
+        return result, True
+
+    result, nullable = first(sre_parse.parse(regex.pattern, regex.flags))
+    return None if nullable else result
+
+
+def regex_items(items):
+    """Yields the (op, av) items of a parsed regex, including the nested ones."""
+    for op, av in items:
+        yield op, av
+        if op == sre_parse.IN:
+            # e.g. the literals and ranges of [a-z_]
+            yield from av
+            continue
+        for value in av if isinstance(av, (tuple, list)) else [av]:
+            # e.g. the content of a group, or the branches of an alternation
+            for sub_items in value if isinstance(value, list) else [value]:
+                if isinstance(sub_items, sre_parse.SubPattern):
+                    yield from regex_items(sub_items)
+
+
+def read_blocks(f, size=BLOCK_SIZE):
+    """Yields the lines of the file f, in lists of lines of (roughly) size bytes."""
+    while True:
+        lines = f.readlines(size)
+        if not lines:
+            return
+        yield lines
+
+
 def read_uncommented_lines(filename):
-    """Yields the uncommented lines read from filename."""
+    """Yields the uncommented lines read from filename, as bytes."""
     try:
-        with open(filename, 'r') as f:
+        with open(filename, 'rb') as f:
             for line in f:
                 line = line.strip()
-                if not line or line.startswith('#'):
+                if not line or line.startswith(b'#'):
                     continue
                 yield line
     except:
@@ -109,19 +415,21 @@ def read_uncommented_lines(filename):
         return
 
 
-class Redacter(object):
+class Redacter:
     """A Redacter instance keeps track of the required information to redact a string.
 
     To identify a secret string, a Redacter uses regular expressions which must
     have EXACTLY one matching group. The string captured by this group can be
     validatated by the `validator` script.
+    The regular expressions, the secrets, their substitutions and the strings to
+    redact are bytes.
     The information used by a Redacter instance is the following:
       - cleartext-to-secret "translations"
 
     Attributes:
         patterns: A list of compiled regex used to identify potential secrets (identified by patterns)
         substitution: The "redacted" string used to replace a secret string
-        substitutions: A (pre-filled) dict which keeps track of the cleartext/redacted relationships
+        substitutions: A (pre-filled) dict which keeps track of the cleartext/redacted relationships (bytes)
         validator: Path to the validator script
     """
     def __init__(self, substitution_string, patterns=None, substitutions=None, validator=None):
@@ -132,11 +440,11 @@ class Redacter(object):
                                  by a unique string. In the redacted output, a suffix is added to
                                  the substitution_string, to ensure its uniqueness. The keys are the
                                  secrets and their value the anonymized string replacing it.
-            patterns: A list of regular expressions used to identify potential (see
+            patterns: A list of regular expressions (bytes) used to identify potential (see
                       `validator` arg) secrets to be redacted. Each regex must have at
                       most one capturing group identifying the secret string.  If it
                       doesn't have any, the whole regex is the secret.
-            substitutions: A dict of pre-defined substitutions. It is the responsibility of the user
+            substitutions: A dict of pre-defined substitutions (bytes). It is the responsibility of the user
                            to ensure their uniqueness. The Reacter doesn't add a suffix to those. 
             validator: Path to a script taking a potential secret string as argument. It's called
                        for each new secret identified. A return code of zero means the secret is
@@ -146,44 +454,109 @@ class Redacter(object):
             raise AttributeError('At least patterns or substitutions must be defined')
 
         self.substitution_string = substitution_string
+        # The prefix of the substitutions of the secrets found
+        self._substitution_prefix = substitution_string.encode('utf-8')
         self.patterns = (
             [Redacter.compile_regex(r) for r in patterns]
             if patterns else []
         )
+        self._compile_patterns()
         self.substitutions = substitutions if substitutions else {}
 
+        # Regexes (or Aho-Corasick automaton) matching all the secrets having a
+        # substitution string (see _compile_substitutions())
+        self._substitutions_regexes = []
+        self._automaton = None
+        # The secrets matched by each regex, the number of secrets compiled and
+        # the secrets found since then
+        self._compiled_secrets = []
+        self._substitutions_count = 0
+        self._new_secrets = []
+        # The number of strings redacted since new secrets were compiled
+        self._stable_lines = 0
+        # The bytes the secrets start with, and the bytes the strings to redact
+        # must contain to have any chance to contain a secret (None if any byte)
+        self._secret_triggers = set()
+        self._compile_triggers()
+        # The bytes the secrets contain after their first one
+        self._secret_tails = set()
+
+        # Regex matching both the patterns and the secrets (see redact())
+        self._fused = None
+
         # To ensure the uniqueness of the secret strings used to anonymize their
         # cleartext counterpart, a number (incremented for each new secret) is
         # appended at the end of the secret string
         self._counter = 0
 
         self.validator = validator
+        # The decisions of the validator script (key=potential secret)
+        self._validate_cache = {}
+        # The output of the validator script is discarded. /dev/null is opened
+        # once, when the validator is first run
+        self._devnull = None
+
+    def __getstate__(self):
+        """Return the state to pickle, without the compiled regex (rebuilt when unpickled)
+        and the open files.
+        """
+        state = self.__dict__.copy()
+        state.update(
+            _combined=None,
+            _pattern_regexes=[],
+            _substitutions_regexes=[],
+            _automaton=None,
+            _compiled_secrets=[],
+            _substitutions_count=0,
+            _new_secrets=[],
+            _fused=None,
+            _devnull=None,
+        )
+        return state
+
+    def close(self):
+        """Close the files opened to run the validator script."""
+        if self._devnull is not None:
+            self._devnull.close()
+            self._devnull = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # __init__ might have failed before setting the attribute
+        if hasattr(self, '_devnull'):
+            self.close()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile_patterns()
 
     @staticmethod
-    def create(substitution_string, regex_file, substitutions_file, validator_file):
+    def create(substitution_string, regex_lines, substitutions_lines, validator_file):
         """
         Return a Redacter instance initialized with the content of the configuration
-        files passed as argument.
+        files (see get_config()).
 
         Args:
             substitution_string: The name of the secret to redact, as a string.
-            regex_file: The path of the file containing the regular expressions used to identify
-                        potential secrets, as a string.
-            substitutions_file: The path of the file containing the pre-defined substitutions for
-                                this redacter (format <secret>=<anonymized string>), as a string
+            regex_lines: The regular expressions used to identify potential secrets, as a list
+                         of bytes.
+            substitutions_lines: The pre-defined substitutions for this redacter (format
+                                 <secret>=<anonymized string>), as a list of bytes.
             validator_file: The path of the script used to validate potential secrets identifed by
                             the regular expression(s), as a string
 
         Returns: A Redacter instance or None if the the creation failed.
         """
-        patterns = [line for line in read_uncommented_lines(regex_file)]
+        patterns = list(regex_lines)
 
         substitutions = {
-            '='.join(parts[:-1]).strip(): parts[-1].strip()
-            for parts in [
-                line.split('=')
-                for line in read_uncommented_lines(substitutions_file)
-            ]
+            b'='.join(parts[:-1]).strip(): parts[-1].strip()
+            for parts in [line.split(b'=') for line in substitutions_lines]
         }
 
         try:
@@ -197,23 +570,27 @@ class Redacter(object):
             return None
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def compile_regex(regex):
         """Validate and return the compiled regular expression.
 
         If the regular expressions doesn't have any capturing group, the whole
         regex is considered as a capturing group. If the regex has more than 1
         capturing group, it's invalid.
+
+        The compiled regular expressions are cached, they are only compiled once
+        even when they are used by multiple Redacter instances.
         """
         compiled = re.compile(regex)
 
         if compiled.groups > 1:
-            raise AttributeError((
-                'regular_expression "{0}" is invalid. It should have at '
-                'most 1 capturing group'
-            ).format(regex))
+            raise AttributeError(
+                f'regular_expression "{regex.decode("utf-8", "replace")}" is invalid. '
+                f'It should have at most 1 capturing group'
+            )
 
         if compiled.groups == 0:
-            compiled = re.compile('({0})'.format(regex))
+            compiled = re.compile(b'(%s)' % regex)
 
         return compiled
 
@@ -221,32 +598,335 @@ class Redacter(object):
         """Return the redacted version of the given string.
 
         Args:
-            string: The string to redact.
+            string: The string to redact, as bytes.
 
-        Returns: The redacted version of the string.
+        Returns: The redacted version of the string, as bytes.
         """
+        if len(self.substitutions) != self._substitutions_count:
+            self._compile_substitutions()
+
+        # Once no new secrets were found for a while, all the secrets are
+        # compiled in a single regex, which is faster to match (and allows the
+        # single pass below). It's not done sooner because it takes time
+        # proportional to the number of secrets.
+        if len(self._substitutions_regexes) > 1:
+            self._stable_lines += 1
+            if self._stable_lines >= max(STABLE_LINES, self._substitutions_count):
+                self._merge_substitutions()
+
+        # Skip the strings which don't contain any byte a (potential) secret
+        # starts with. Deleting those bytes is much faster than matching regexes.
+        if self._triggers is not None and len(string.translate(None, self._triggers)) == len(string):
+            return string
+
+        # Find the potential secrets and substitute the known secrets in a
+        # single pass, if it gives the same result as the two passes below
+        if self._fused is not None:
+            redacted = self._redact_fused(string)
+            if redacted is not None:
+                return redacted
+
         # Make sure each secret found has a substitution string defined
-        for pattern in self.patterns:
-            for secret in pattern.findall(string):
-                # Skip the secret if it already has a substitution string
-                if secret in self.substitutions:
+        if self.patterns:
+            # Each pattern is matched on its own, so that the matches of
+            # different patterns may overlap. The combined regex only tells if
+            # any of its patterns matches the string
+            found = self._combined is not None and self._combined.search(string) is not None
+            matches = []
+            for regex, combined in self._pattern_regexes:
+                if combined and not found:
                     continue
-                if self.validate(secret):
-                    substitution = '{0}{1}'.format(self.substitution_string, self._counter)
-                    self._counter += 1
-                    self.substitutions[secret] = substitution
-
-        # Redact the string replacing each secret with its substitution string.
-        # The longest secrets are readacted first because some secrets might be
-        # substrings of other secrets (e.g. IP addresses)
-        for secret, substitution in sorted(
-            self.substitutions.iteritems(),
-            key=lambda i: len(i[0]),
-            reverse=True
-        ):
-            string = string.replace(secret, self.substitutions[secret])
-
-        return string
+                for match in regex.finditer(string):
+                    secret = match.group(match.lastindex) if match.lastindex else None
+                    # Skip the secret if it already has a substitution string
+                    if secret and secret not in self.substitutions:
+                        matches.append((match.start(), secret))
+
+            # The secrets are numbered in the order they appear in the string
+            candidates = []
+            for _, secret in sorted(matches, key=lambda m: m[0]):
+                if secret not in candidates:
+                    candidates.append(secret)
+
+            for secret in self.validate_all(candidates):
+                substitution = b'%s%d' % (self._substitution_prefix, self._counter)
+                self._counter += 1
+                self.substitutions[secret] = substitution
+                self._new_secrets.append(secret)
+
+        if len(self.substitutions) != self._substitutions_count:
+            self._compile_substitutions()
+
+        # Redact the string replacing each secret with its substitution string
+        return self._substitute(string)
+
+    def _redact_fused(self, string):
+        """Return the string redacted in a single pass with the fused regex.
+
+        The result is the same as the two passes of redact() only if:
+          - all the potential secrets found already have a substitution string
+            (or were rejected by the validator). Otherwise, their previous
+            occurrences in the string must be redacted too.
+          - the patterns are matched only if there is one, the matches of
+            several patterns may overlap.
+          - no match of the patterns starts inside a known secret, the first
+            pass would find it.
+          - no known secret starts inside a match of the patterns and ends
+            after it, the second pass would substitute it.
+
+        Returns: The redacted string, or None if it must be redacted in two passes.
+        """
+        groups = self._fused.groups
+        secrets = self._substitutions_regexes[0]
+        # The secrets are sorted longest first
+        longest = len(self._compiled_secrets[0][0])
+        # The first match of the patterns after the start of the last known
+        # secret, searched only when it's before it
+        pattern = None
+        searched = False
+        failed = False
+
+        def substitute(match):
+            nonlocal pattern, searched, failed
+            if failed:
+                return b''
+            start, end = match.span()
+
+            # The last group captures the known secrets, the other ones the patterns
+            if match.lastindex == groups:
+                if not searched or (pattern is not None and pattern.start() <= start):
+                    pattern = self._combined.search(string, start + 1)
+                    searched = True
+                failed = pattern is not None and pattern.start() < end
+                return self.substitutions[match.group(groups)]
+
+            # The matches of the other patterns may overlap this one
+            if len(self.patterns) > 1:
+                failed = True
+                return b''
+            secret = match.group(match.lastindex) if match.lastindex else None
+            if secret and secret not in self.substitutions and self._validate_cache.get(secret, True):
+                failed = True
+                return b''
+
+            # The known secrets ending after the match contain the byte following
+            # it, and start at most `longest` bytes before its end
+            if end < len(string) and string[end] in self._secret_tails:
+                position = max(start, end - longest + 1)
+                while True:
+                    found = secrets.search(string, position, end + longest - 1)
+                    if found is None or found.start() >= end:
+                        break
+                    if found.end() > end:
+                        failed = True
+                        return b''
+                    position = found.start() + 1
+
+            if secret in self.substitutions and secret == match.group(0):
+                return self.substitutions[secret]
+            return self._substitute(match.group(0))
+
+        redacted = self._fused.sub(substitute, string)
+        return None if failed else redacted
+
+    def _substitute(self, string):
+        """Return the string with each secret replaced by its substitution string.
+
+        The secrets are replaced from left to right. If multiple secrets start
+        at the same position, the longest one is replaced.
+        """
+        if self._automaton is not None:
+            # The automaton matches text, latin-1 maps each byte to one character.
+            # It finds all the (overlapping) secrets, sorted by start and length
+            # here (iter_long() misses some of the leftmost-longest ones).
+            found = sorted(
+                (end - len(secret) + 1, -len(secret), secret)
+                for end, secret in self._automaton.iter(string.decode('latin-1'))
+            )
+            parts = []
+            position = 0
+            for start, length, secret in found:
+                if start < position:
+                    continue
+                parts.append(string[position:start])
+                parts.append(self.substitutions[secret])
+                position = start - length
+            parts.append(string[position:])
+            return b''.join(parts)
+
+        regexes = self._substitutions_regexes
+        if len(regexes) == 1:
+            # The secrets captured by the regex are the odd items. They are all
+            # substituted at once, without calling a Python function per secret
+            parts = regexes[0].split(string)
+            parts[1::2] = map(self.substitutions.__getitem__, parts[1::2])
+            return b''.join(parts)
+
+        # Replace the leftmost secret matched by any regex, then search again
+        # with the regexes whose next match started before the end of that secret
+        parts = []
+        position = 0
+        matches = [regex.search(string) for regex in regexes]
+        while True:
+            found = [m for m in matches if m]
+            if not found:
+                break
+            match = min(found, key=lambda m: (m.start(), -m.end()))
+            parts.append(string[position:match.start()])
+            parts.append(self.substitutions[match.group()])
+            position = match.end()
+            matches = [
+                m if not m or m.start() >= position else regex.search(string, position)
+                for m, regex in zip(matches, regexes)
+            ]
+        parts.append(string[position:])
+        return b''.join(parts)
+
+    def _compile_patterns(self):
+        """Compile the regex of each pattern, and the regex matching any of the patterns.
+
+        The regex matching any of the patterns is one alternation, each branch
+        having exactly one capturing group (see compile_regex()). The patterns
+        which wouldn't mean the same in the alternation are left out of it (see
+        _combinable()).
+        """
+        self._pattern_regexes = [
+            (compile_linear_regex(p.pattern), Redacter._combinable(p))
+            for p in self.patterns
+        ]
+        combined = b'|'.join(b'(?:%s)' % p.pattern for p in self.patterns if Redacter._combinable(p))
+        # The fused regex can be matched by RE2 if the combined regex can (the
+        # known secrets are non-empty literals)
+        self._combined_compatible = re2 is not None and bool(combined) and re2_compatible(combined)
+        self._combined = (
+            compile_linear_regex(combined, self._combined_compatible) if combined else None
+        )
+        triggers = [first_bytes(p) for p in self.patterns]
+        self._pattern_triggers = None if None in triggers else set().union(*triggers)
+
+    @staticmethod
+    def _combinable(pattern):
+        """Return True if the compiled pattern can be a branch of the combined regex.
+
+        Global flags (e.g. (?i)) must be at the start of a regex, named groups
+        must be unique, and the backreferences would refer to another group
+        once the groups of the other patterns are numbered before them.
+        """
+        if pattern.flags or pattern.groupindex:
+            return False
+        return not any(
+            op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+            for op, _ in regex_items(sre_parse.parse(pattern.pattern))
+        )
+
+    def _compile_triggers(self):
+        """Compile the bytes a string must contain to have any chance to contain a secret."""
+        if self._pattern_triggers is None:
+            self._triggers = None
+        else:
+            self._triggers = bytes(sorted(self._pattern_triggers | self._secret_triggers))
+
+    def _compile_substitutions(self):
+        """Compile the regexes capturing all the secrets having a substitution string.
+
+        Compiling a regex takes time proportional to the number of secrets it
+        matches, so the new secrets aren't compiled with all the other ones.
+        They are compiled in a new regex, merged with the smallest existing
+        regexes (like the digits of a binary counter) until the regexes have
+        decreasing sizes. Each secret is thus only recompiled a few times.
+
+        When all the secrets are matched by a single regex, the fused regex is
+        compiled: the alternation of the patterns (first, so that they have
+        precedence) and the secrets. The regexes are also all merged once no
+        new secret was found for a while (see redact()).
+
+        The longest secrets come first in the alternations because some secrets
+        might be substrings of other secrets (e.g. IP addresses). Each level
+        is kept sorted, so only the new secrets are sorted and the levels are
+        merged in linear time.
+
+        If the ahocorasick module is available, an Aho-Corasick automaton is
+        also built when all the secrets are in a single regex (see
+        _compile_automaton()).
+        """
+        new_secrets = self._new_secrets
+        self._new_secrets = []
+        if self._substitutions_count + len(new_secrets) != len(self.substitutions):
+            # The substitutions were (also) set from the outside, start over
+            new_secrets = list(self.substitutions)
+            self._substitutions_regexes = []
+            self._automaton = None
+            self._compiled_secrets = []
+            self._secret_triggers = set()
+            self._secret_tails = set()
+        self._substitutions_count = len(self.substitutions)
+        self._stable_lines = 0
+        new_secrets = [secret for secret in new_secrets if secret]
+        self._fused = None
+
+        self._secret_triggers.update(secret[0] for secret in new_secrets)
+        self._secret_tails.update(*(secret[1:] for secret in new_secrets))
+        self._compile_triggers()
+
+        new_secrets.sort(key=len, reverse=True)
+        while self._compiled_secrets and len(self._compiled_secrets[-1]) <= len(new_secrets):
+            new_secrets = list(heapq.merge(
+                self._compiled_secrets.pop(), new_secrets, key=len, reverse=True,
+            ))
+            self._substitutions_regexes.pop()
+
+        if new_secrets:
+            self._compiled_secrets.append(new_secrets)
+            self._substitutions_regexes.append(Redacter._compile_secrets(new_secrets))
+            self._compile_automaton()
+
+        self._compile_fused()
+
+    def _merge_substitutions(self):
+        """Compile all the secrets having a substitution string in a single regex."""
+        secrets = list(heapq.merge(*self._compiled_secrets, key=len, reverse=True))
+        self._compiled_secrets = [secrets]
+        self._substitutions_regexes = [Redacter._compile_secrets(secrets)]
+        self._compile_automaton()
+        self._compile_fused()
+
+    def _compile_automaton(self):
+        """Build the Aho-Corasick automaton, if all the secrets are matched by a single regex.
+
+        Building the automaton takes time proportional to the number of secrets,
+        like compiling a regex. It's only rebuilt when the regexes are all merged,
+        so each secret is added to it a few times only (see _compile_substitutions()).
+        Until then, the secrets are substituted with the regexes.
+        """
+        self._automaton = None
+        if ahocorasick is None or len(self._compiled_secrets) != 1:
+            return
+        automaton = ahocorasick.Automaton()
+        try:
+            for secret in self._compiled_secrets[0]:
+                automaton.add_word(secret.decode('latin-1'), secret)
+        except TypeError:
+            # The automaton doesn't support this type of string (built for bytes)
+            return
+        automaton.make_automaton()
+        self._automaton = automaton
+
+    def _compile_fused(self):
+        """Compile the fused regex, if all the secrets are matched by a single regex."""
+        self._fused = (
+            compile_linear_regex(b'%s|%s' % (
+                self._combined.pattern,
+                self._substitutions_regexes[0].pattern,
+            ), self._combined_compatible)
+            if self._combined and all(combined for _, combined in self._pattern_regexes)
+            and len(self._substitutions_regexes) == 1
+            else None
+        )
+
+    @staticmethod
+    def _compile_secrets(secrets):
+        """Return the compiled regex capturing any of the secrets (sorted longest first)."""
+        return compile_linear_regex(b'(%s)' % b'|'.join(map(re.escape, secrets)), True)
 
     def validate(self, secret):
         """Return True if the secret is really a secret.
@@ -258,11 +938,37 @@ class Redacter(object):
 
         Returns: True if the string is a secret, false otherwise.
         """
+        return bool(self.validate_all([secret]))
+
+    def validate_all(self, secrets):
+        """Return the secrets which are really secrets, in the same order.
+
+        The validator script is used to decide. It's run for (up to
+        MAX_VALIDATORS) secrets at the same time. Its decisions are cached,
+        it's run only once per string.
+
+        Args:
+            secrets: A list of strings which are potentially secrets
+
+        Returns: A list of the strings which are secrets.
+        """
         if not self.validator:
-            return True
+            return list(secrets)
 
-        with open(os.devnull, 'w') as devnull:
-            return subprocess.call([self.validator, secret], stdout=devnull) == 0
+        unknown = [secret for secret in secrets if secret not in self._validate_cache]
+        if unknown and self._devnull is None:
+            self._devnull = open(os.devnull, 'wb')
+
+        for i in range(0, len(unknown), MAX_VALIDATORS):
+            batch = unknown[i:i + MAX_VALIDATORS]
+            processes = [
+                subprocess.Popen([self.validator, secret], stdout=self._devnull)
+                for secret in batch
+            ]
+            for secret, process in zip(batch, processes):
+                self._validate_cache[secret] = process.wait() == 0
+
+        return [secret for secret in secrets if self._validate_cache[secret]]
 
 
 if __name__ == '__main__':
@@ -285,6 +991,12 @@ if __name__ == '__main__':
         nargs='+',
         help='only redact those secrets',
     )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=1,
+        help='number of processes redacting the file (default: 1)',
+    )
     parser.add_argument(
         '--write-substitutions', '-w',
         help='write the substitution to that directory',
@@ -1,12 +1,18 @@
 import unittest
 import os
+import pickle
+import re
 import sys
+import tempfile
 
 # https://docs.python-guide.org/writing/structure/
 project_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_directory)
 
-from redact import Redacter
+from redact import (
+    PATTERNS, STABLE_LINES, SUBSTITUTIONS, VALIDATORS,
+    Redacter, first_bytes, get_config, re2, redact_block, redact_parallel,
+)
 
 class TestRedacter(unittest.TestCase):
 
@@ -15,68 +21,240 @@ class TestRedacter(unittest.TestCase):
             self.assertraisesRedacter('test')
 
     def test_init_substitutions(self):
-        s = {'secret': 'substitution'}
+        s = {b'secret': b'substitution'}
         r = Redacter('redact', substitutions=s)
         self.assertEqual(r.substitutions, s)
 
     def test_init_patterns(self):
-        p = [r'test']
+        p = [br'test']
         r = Redacter('redact', patterns=p)
-        self.assertEqual(len(r.patterns[0].search('This is a test').groups()), 1)
+        self.assertEqual(len(r.patterns[0].search(b'This is a test').groups()), 1)
+
+    def test_compile_regex_cached(self):
+        r1 = Redacter('redact', patterns=[br'cached: (\S+)'])
+        r2 = Redacter('other', patterns=[br'cached: (\S+)'])
+        self.assertIs(r1.patterns[0], r2.patterns[0])
+
+    def test_first_bytes(self):
+        def first(regex):
+            result = first_bytes(re.compile(regex))
+            return None if result is None else bytes(bytearray(sorted(result)))
+        self.assertEqual(first(br'\d+\.\d+'), b'0123456789')
+        self.assertEqual(first(br'user "(.+)"'), b'u')
+        self.assertEqual(first(br'(?:a|[bc])?d'), b'abcd')
+        self.assertEqual(first(br'^(?=x)y'), b'y')
+        self.assertIsNone(first(br'\S+'))
+        self.assertIsNone(first(br'a*'))
+        self.assertIsNone(first(br'(?i)a'))
+
+    def test_redact_without_trigger(self):
+        r = Redacter('redact', patterns=[br'secret: (\S+)'], substitutions={b'test': b'x'})
+        self.assertEqual(r.redact(b'nothing to see here'), b'nothing to see here')
+        self.assertEqual(r.redact(b'secret: y'), b'secret: redact0')
+        self.assertEqual(r.redact(b'y'), b'redact0')
 
     def test_redact_with_substitutions(self):
-        s = {'secretA': 'x', 'secretB': 'y'}
+        s = {b'secretA': b'x', b'secretB': b'y'}
+        r = Redacter('redact', substitutions=s)
+        self.assertEqual(r.redact(b'secretA'), b'x')
+        self.assertEqual(r.redact(b' secretA'), b' x')
+        self.assertEqual(r.redact(b'secretA '), b'x ')
+        self.assertEqual(r.redact(b'secretAsecretA'), b'xx')
+        self.assertEqual(r.redact(b'secretA secretA'), b'x x')
+        self.assertEqual(r.redact(b'secretAsecretB'), b'xy')
+
+    def test_redact_with_substitutions_single_pass(self):
+        # A substitution string must not be redacted again
+        s = {b'a': b'b', b'b': b'c', b'ab': b'x'}
         r = Redacter('redact', substitutions=s)
-        self.assertEqual(r.redact('secretA'), 'x')
-        self.assertEqual(r.redact(' secretA'), ' x')
-        self.assertEqual(r.redact('secretA '), 'x ')
-        self.assertEqual(r.redact('secretAsecretA'), 'xx')
-        self.assertEqual(r.redact('secretA secretA'), 'x x')
-        self.assertEqual(r.redact('secretAsecretB'), 'xy')
+        self.assertEqual(r.redact(b'ab'), b'x')
+        self.assertEqual(r.redact(b'ba'), b'cb')
+
+    def test_redact_with_substitutions_overlapping(self):
+        # The leftmost secret is substituted, the longest one if several start there
+        s = {b'ac': b'1', b'bb': b'2', b'a': b'3', b'bbca': b'4', b'cac': b'5'}
+        r = Redacter('redact', substitutions=s)
+        self.assertEqual(r.redact(b'a baa ca bca'), b'3 b33 c3 bc3')
+        self.assertEqual(r.redact(b'bbcacac'), b'45')
 
     def test_redact_with_patterns(self):
-        p = [r'secretA', 'secret: (\S+)']
+        p = [br'secretA', b'secret: (\S+)']
         r1 = Redacter('redact', patterns=p)
         r2 = Redacter('redact', patterns=p)
-        self.assertEqual(r1.redact('secretA'), 'redact0')
-        self.assertEqual(r2.redact('secret: x'), 'secret: redact0')
-        self.assertEqual(r1.redact('secret: x'), 'secret: redact1')
-        self.assertEqual(r1.redact('x'), 'redact1')
+        self.assertEqual(r1.redact(b'secretA'), b'redact0')
+        self.assertEqual(r2.redact(b'secret: x'), b'secret: redact0')
+        self.assertEqual(r1.redact(b'secret: x'), b'secret: redact1')
+        self.assertEqual(r1.redact(b'x'), b'redact1')
+
+    def test_redact_with_multiple_patterns_same_line(self):
+        p = [br'secretA', b'secret: (\S+)']
+        r = Redacter('redact', patterns=p)
+        self.assertEqual(r.redact(b'secret: x secretA'), b'secret: redact0 redact1')
+        self.assertEqual(r.redact(b'secretA x'), b'redact1 redact0')
+
+    def test_redact_with_patterns_global_flags(self):
+        p = [br'(?i)user "(.+)"', br'secret: (\S+)']
+        r = Redacter('redact', patterns=p)
+        self.assertEqual(r.redact(b'secret: x USER "y"'), b'secret: redact0 USER "redact1"')
+
+    def test_redact_with_patterns_named_groups_and_backreferences(self):
+        p = [br'(?P<s>\w+)@x', br'(?P<s>\w+)@y', br'secret: (\S+)', br'id=(\d+)/\1']
+        r = Redacter('redact', patterns=p)
+        self.assertEqual(r.redact(b'secret: a b@x z@y'), b'secret: redact0 redact1@x redact2@y')
+        self.assertEqual(r.redact(b'id=12/12 id=3/4'), b'id=redact3/redact3 id=3/4')
+
+    def test_redact_with_patterns_overlapping(self):
+        p = [br'session (\S+)', br'user=(\w+)']
+        r = Redacter('s', patterns=p)
+        self.assertEqual(r.redact(b'session abc,user=bob'), b'session s0')
+        self.assertEqual(r.redact(b'bob again'), b's1 again')
 
     def test_redact_with_patterns_substring(self):
-        p = [r'A\S*']
+        p = [br'A\S*']
         r = Redacter('redact', patterns=p)
-        self.assertEqual(r.redact('A'), 'redact0')
-        self.assertEqual(r.redact('AA'), 'redact1')
-        self.assertEqual(r.redact('AB'), 'redact2')
-        self.assertEqual(r.redact('XAB'), 'Xredact2')
+        self.assertEqual(r.redact(b'A'), b'redact0')
+        self.assertEqual(r.redact(b'AA'), b'redact1')
+        self.assertEqual(r.redact(b'AB'), b'redact2')
+        self.assertEqual(r.redact(b'XAB'), b'Xredact2')
+
+    def test_redact_with_many_patterns_found(self):
+        p = [br'<(\w+)>']
+        r = Redacter('r', patterns=p)
+        self.assertEqual(r.redact(b'<abcd> <xy> <abc>'), b'<r0> <r1> <r2>')
+        self.assertEqual(r.redact(b'abcx abcd'), b'r2x r0')
+        self.assertEqual(r.redact(b'<a> <b> abcd xy ab'), b'<r3> <r4> r0 r1 r3r4')
+        # Once no new secret is found for a while, the secrets are merged
+        for _ in range(STABLE_LINES):
+            self.assertEqual(r.redact(b'abcx abcd'), b'r2x r0')
+        self.assertEqual(r.redact(b'<a> <b> abcd xy ab'), b'<r3> <r4> r0 r1 r3r4')
+        self.assertEqual(r.redact(b'<e> <abc>'), b'<r5> <r2>')
 
     def test_redact_with_patterns_and_substitutions(self):
-        p = [r'secret: (\S+)']
-        s = {'test': 'x'}
+        p = [br'secret: (\S+)']
+        s = {b'test': b'x'}
         r = Redacter('redact', patterns=p, substitutions=s)
-        self.assertEqual(r.redact('secret: test'), 'secret: x')
-        self.assertEqual(r.redact('secret: te'), 'secret: redact0')
-        self.assertEqual(r.redact('secret: tes'), 'secret: redact1')
-        self.assertEqual(r.redact('test'), 'x')
-        self.assertEqual(r.redact('te'), 'redact0')
-        self.assertEqual(r.redact('tes'), 'redact1')
+        self.assertEqual(r.redact(b'secret: test'), b'secret: x')
+        self.assertEqual(r.redact(b'secret: te'), b'secret: redact0')
+        self.assertEqual(r.redact(b'secret: tes'), b'secret: redact1')
+        self.assertEqual(r.redact(b'test'), b'x')
+        self.assertEqual(r.redact(b'te'), b'redact0')
+        self.assertEqual(r.redact(b'tes'), b'redact1')
+
+    def test_redact_with_patterns_and_overlapping_substitutions(self):
+        # A match of a pattern starting inside a known secret
+        r = Redacter('r', patterns=[br'b(\d+)'], substitutions={b'ab': b'X'})
+        self.assertEqual(r.redact(b'ab12'), b'Xr0')
+        r = Redacter('r', patterns=[br'u=(\w+)'], substitutions={b'3u': b'X'})
+        self.assertEqual(r.redact(b'b03u=bba'), b'b0X=r0')
+        # A known secret starting inside a match of a pattern
+        r = Redacter('r', patterns=[br'k(\d)'], substitutions={b'1': b'X', b'12': b'Y'})
+        self.assertEqual(r.redact(b'k12'), b'kY')
+        self.assertEqual(r.redact(b'k1 k12'), b'kX kY')
 
     def test_redact_with_pattens_secret_in_text(self):
         # Using the example from the README (chapter "Caveats")
-        p = [r'using password "(.+)"$']
+        p = [br'using password "(.+)"$']
         r = Redacter('secret', patterns=p)
         self.assertEqual(
-            r.redact('authentication successful using password "password"'),
-            'authentication successful using secret0 "secret0"',
+            r.redact(b'authentication successful using password "password"'),
+            b'authentication successful using secret0 "secret0"',
         )
 
+    @unittest.skipUnless(re2, 'requires the re2 module')
+    def test_redact_with_re2(self):
+        # RE2 would match $ only at the end of the string and \s not with \v
+        r = Redacter('file', patterns=[br'new file (.+)$', br'name:\s(\S+)'])
+        self.assertEqual(r.redact(b'new file x\n'), b'new file file0\n')
+        self.assertEqual(r.redact(b'name:\vy\vz'), b'name:\vfile1\vz')
+        # RE2 wouldn't look for a non-empty match after an empty one
+        r = Redacter('r', patterns=[br'a*'], substitutions={b'b': b'S0'})
+        self.assertEqual(r.redact(b'  bbx=b  '), b'  S0S0x=S0  ')
+
     def test_redact_with_validator(self):
-        p = [r'\d+\.\d+\.\d+\.\d+']
+        p = [br'\d+\.\d+\.\d+\.\d+']
         v = os.path.join(
             project_directory,
             'tests', 'config', 'etc', 'redact', 'validators', 'ipv4_address'
         )
-        r = Redacter('redact', patterns=p, validator=v)
-        self.assertEqual(r.redact('10.10.255.1'), 'redact0')
-        self.assertEqual(r.redact('10.10.299.1'), '10.10.299.1')
+        with Redacter('redact', patterns=p, validator=v) as r:
+            self.assertEqual(r.redact(b'10.10.255.1'), b'redact0')
+            self.assertEqual(r.redact(b'10.10.299.1'), b'10.10.299.1')
+        # The file opened to run the validator script is closed
+        self.assertIsNone(r._devnull)
+
+    def test_redact_with_validator_multiple_secrets(self):
+        p = [br'\d+\.\d+\.\d+\.\d+']
+        v = os.path.join(
+            project_directory,
+            'tests', 'config', 'etc', 'redact', 'validators', 'ipv4_address'
+        )
+        with Redacter('redact', patterns=p, validator=v) as r:
+            self.assertEqual(
+                r.redact(b'10.0.0.1 10.0.0.300 10.0.0.2 10.0.0.1'),
+                b'redact0 10.0.0.300 redact1 redact0',
+            )
+
+    def test_validate_cached(self):
+        v = os.path.join(
+            project_directory,
+            'tests', 'config', 'etc', 'redact', 'validators', 'ipv4_address'
+        )
+        with Redacter('redact', patterns=[br'\S+'], validator=v) as r:
+            self.assertFalse(r.validate(b'10.0.0.300'))
+            # The validator script isn't run again
+            r.validator = os.devnull
+            self.assertFalse(r.validate(b'10.0.0.300'))
+            self.assertEqual(r.validate_all([b'10.0.0.300']), [])
+
+    def test_pickle(self):
+        r = Redacter('redact', patterns=[br'secret: (\S+)'], substitutions={b'test': b'x'})
+        self.assertEqual(r.redact(b'secret: y test'), b'secret: redact0 x')
+        r = pickle.loads(pickle.dumps(r))
+        self.assertEqual(r.redact(b'secret: z y test'), b'secret: redact1 redact0 x')
+
+    def test_redact_parallel(self):
+        def redacters():
+            return [
+                Redacter('hostname', patterns=[br'\S+\.internal\.domain']),
+                Redacter('username', patterns=[br'user "(.+)": login']),
+            ]
+        with open(os.path.join(project_directory, 'tests', 'files', 'test1.txt'), 'rb') as f:
+            lines = f.readlines()
+        blocks = [lines[i:i + 3] for i in range(0, len(lines), 3)]
+
+        sequential = redacters()
+        expected = [redact_block(sequential, block)[0] for block in blocks]
+        parallel = redacters()
+        self.assertEqual(list(redact_parallel(blocks, parallel, 2)), expected)
+        for r1, r2 in zip(sequential, parallel):
+            self.assertEqual(r1.substitutions, r2.substitutions)
+
+    def test_redact_parallel_validator_cached(self):
+        with tempfile.TemporaryDirectory() as d:
+            # The validator rejects all the secrets, and logs each run
+            v = os.path.join(d, 'validator')
+            with open(v, 'w') as f:
+                f.write('#!/bin/sh\necho "$1" >> "$0.log"\nexit 1\n')
+            os.chmod(v, 0o755)
+            with Redacter('ip', patterns=[br'ip=(\S+)'], validator=v) as r:
+                blocks = [[b'ip=bogus\n']] * 20
+                self.assertEqual(list(redact_parallel(blocks, [r], 2)), blocks)
+            # Only the blocks submitted before the first decision was known
+            # run the validator
+            with open(v + '.log') as f:
+                self.assertLessEqual(len(f.readlines()), 4)
+
+    def test_get_config(self):
+        config = get_config([
+            os.path.join(project_directory, 'tests', 'config', 'home', 'redact'),
+            os.path.join(project_directory, 'tests', 'config', 'etc', 'redact'),
+        ])
+        self.assertEqual(sorted(config), ['file', 'hostname', 'ipv4_address', 'username'])
+        # The first configuration file found is used
+        self.assertEqual(
+            config['username'][PATTERNS],
+            [b'user "(.+)": login (?:successful|failed)'],
+        )
+        self.assertEqual(config['hostname'][SUBSTITUTIONS][0], b'db01.internal.domain = DB')
+        self.assertTrue(config['ipv4_address'][VALIDATORS].endswith('ipv4_address'))
+        self.assertNotIn(VALIDATORS, config['hostname'])